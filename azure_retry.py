@@ -0,0 +1,31 @@
+# azure_retry.py
+
+from openai import APIConnectionError, APITimeoutError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+_backoff = wait_random_exponential(min=1, max=30)
+
+
+def wait_retry_after(retry_state):
+    """Wartet so lange, wie Azure im retry-after-Header eines 429 verlangt, sonst exponentiell mit Jitter."""
+    error = retry_state.outcome.exception()
+    if isinstance(error, RateLimitError):
+        retry_after = error.response.headers.get("retry-after")
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            pass
+    return _backoff(retry_state)
+
+
+def retry_transient(attempts):
+    """
+    Tenacity-Decorator für vorübergehende Azure-Fehler (429, Timeouts, Verbindungsfehler).
+    Nach 'attempts' Versuchen wird der letzte Fehler weitergereicht; alle anderen Fehler sofort.
+    """
+    return retry(
+        retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError)),
+        wait=wait_retry_after,
+        stop=stop_after_attempt(attempts),
+        reraise=True,
+    )
@@ -1,10 +1,48 @@
 # classes.py
 
+import asyncio
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import ClassVar
+
+import orjson
+
+from setupenv import acall_openai, acall_openai_stream, call_openai, model, prompt_cache_hint
+from setupenv import client as _default_client
+
+# Personas als Modul-Konstanten: der Anfang jedes Prompts ist damit byte-identisch,
+# sodass Azure den Prefix-Cache für wiederholte Aufrufe nutzen kann.
+TECHNOLOGY_PERSONA = "Du bist ein erfahrener Technologie-Analyst. Du recherchierst nur Informationen zu technologischen Trends"
+MARKET_PERSONA = "Du bist ein erfahrener Markt-Analyst. Du recherchierst nur Informationen zu Marktdynamiken und wie sich ein Markt entwickelt"
+REGULATION_PERSONA = "Du bist ein erfahrener Regulationen-Spezialist. Du sammelst nur Informationen zu Regulationen zu einem Thema in der Schweiz."
+MULTI_PERSONA = (
+    "Du bist drei Experten in einem: ein erfahrener Technologie-Analyst, ein erfahrener Markt-Analyst "
+    "und ein erfahrener Regulationen-Spezialist für die Schweiz. "
+    "Deine Antwort muss IMMER ein gültiges JSON-Objekt sein, das KEINEN zusätzlichen Text enthält."
+)
+SUMMARY_PERSONA = "You are an energy strategist skilled at synthesizing expert insights."
+COMPRESSION_PERSONA = "You compress expert research to at most 150 tokens while preserving all key facts, figures and names."
+
+# JSON-Modus: Azure garantiert ein syntaktisch gültiges JSON-Objekt (der Prompt muss "JSON" enthalten)
+JSON_OBJECT = {"type": "json_object"}
+
+# Platzhalter für einen Agenten, der die Frist in run_research nicht eingehalten hat
+SKIPPED = "(skipped: no answer within the deadline)"
+
+# Expertenantworten unterhalb dieser Länge (Zeichen) werden nicht erst komprimiert
+COMPRESSION_MIN_CHARS = 1000
+
+
 class BaseAgent:
     """Eine Basisklasse, die die Grundstruktur für alle Agenten definiert."""
-    def __init__(self, name: str, persona: str, client):
-        self.name = name
-        self.persona = persona
+    def __init__(self, name: str = None, persona: str = None, client=None):
+        # Spezialisierte Agenten definieren name und persona auf Klassenebene
+        if name is not None:
+            self.name = name
+        if persona is not None:
+            self.persona = persona
         self.client = client
 
     def execute(self, task: str, context: str = "") -> str:
@@ -12,140 +50,409 @@ class BaseAgent:
         raise NotImplementedError("Die 'execute'-Methode muss von einer Subklasse implementiert werden.")
 
 
-class TechnologyAgent(BaseAgent):
-    """Ein Agent, der auf die Recherche von Technologischen Trends spezialisiert ist."""
+class PromptTemplateAgent(BaseAgent):
+    """
+    Basisklasse für Agenten, deren Anfrage nur aus Persona (System-Prompt) und einem
+    User-Prompt-Template besteht. Subklassen definieren name, persona, description,
+    user_template und activity auf Klassenebene; der System-Prompt ist damit für jeden
+    Aufruf derselbe String und nur der Inhalt des User-Prompts wird pro Aufruf gebaut.
+    Alle Aufrufe laufen über die gemeinsamen Clients aus setupenv (Cache, Retries, Rate-Limit).
+    """
 
-    def __init__(self, client=None):
-        name = "Technology Expert"
-        persona = "Du bist ein erfahrener Technologie-Analyst. Du recherchierst nur Informationen zu technologischen Trends"
-        
-        # Use global client if none provided
-        if client is None:
-            try:
-                import __main__
-                client = __main__.client
-            except AttributeError:
-                raise ValueError("No client provided and no global 'client' found. Please pass a client parameter.")
-        
-        super().__init__(name, persona, client)
-        self.description = f"Dieser Agent heisst: {self.name.lower()}. Er kann recherchieren und Informationen zu technologischen Trends sammeln."
+    user_template: ClassVar[str]
+    activity: ClassVar[str]
+
+    def __init__(self):
+        super().__init__()
 
     def get_description(self):
         """Returns the agent's description."""
         return self.description
 
+    def _user_prompt(self, task: str) -> str:
+        return self.user_template.format(task=task)
+
     def execute(self, task: str) -> str:
-        print(f"INFO: {self.name} führt Recherche für '{task}' aus...")
-        from helpers import call_openai, model
-        system_prompt = self.persona
-        user_prompt = f"Recherchiere das folgende Thema aus deiner Perspektive: {task}"
-        response = call_openai(
+        print(f"INFO: {self.name} {self.activity} ('{task}')...")
+        return call_openai(
             model=model,
-            system_prompt=system_prompt,
-            user_prompt=user_prompt
+            system_prompt=self.persona,
+            user_prompt=self._user_prompt(task),
+            prompt_cache_key=self.name
         )
-        return response
 
+    async def aexecute(self, task: str) -> str:
+        print(f"INFO: {self.name} {self.activity} ('{task}', async)...")
+        return await acall_openai(
+            model=model,
+            system_prompt=self.persona,
+            user_prompt=self._user_prompt(task),
+            prompt_cache_key=self.name
+        )
 
-class MarketAnalysis(BaseAgent):
-    """Ein Agent, der die Markt-Dynamiken recherchiert"""
+    async def astream(self, task: str):
+        print(f"INFO: {self.name} {self.activity} ('{task}', stream)...")
+        async for delta in acall_openai_stream(
+            model=model,
+            system_prompt=self.persona,
+            user_prompt=self._user_prompt(task),
+            prompt_cache_key=self.name
+        ):
+            yield delta
 
-    def __init__(self, client=None):
-        name = "Market Analyst"
-        persona = "Du bist ein erfahrener Markt-Analyst. Du recherchierst nur Informationen zu Marktdynamiken und wie sich ein Markt entwickelt"
-        
-        # Use global client if none provided
-        if client is None:
-            try:
-                import __main__
-                client = __main__.client
-            except AttributeError:
-                raise ValueError("No client provided and no global 'client' found. Please pass a client parameter.")
-        
-        super().__init__(name, persona, client)
-        self.description = f"Dieser Agent heisst: {self.name.lower()}. Er kann informationen zu Market Trends recherchieren"
 
-    def get_description(self):
-        """Returns the agent's description."""
-        return self.description
+class TechnologyAgent(PromptTemplateAgent):
+    """Ein Agent, der auf die Recherche von Technologischen Trends spezialisiert ist."""
 
-    def execute(self, text: str) -> str:
-        print(f"INFO: {self.name} übersetzt und fasst den Text zusammen...")
-        from helpers import call_openai, model
-        system_prompt = self.persona
-        user_prompt = f"Recherchiere das folgende Thema aus deiner Perspektive:\n\n{text}"
-        response = call_openai(
-            model=model,
-            system_prompt=system_prompt,
-            user_prompt=user_prompt
-        )
-        return response
+    name: ClassVar[str] = "Technology Expert"
+    persona: ClassVar[str] = TECHNOLOGY_PERSONA
+    description: ClassVar[str] = f"Dieser Agent heisst: {name.lower()}. Er kann recherchieren und Informationen zu technologischen Trends sammeln."
+    user_template: ClassVar[str] = "Recherchiere das folgende Thema aus deiner Perspektive: {task}"
+    activity: ClassVar[str] = "führt Recherche aus"
 
 
-class RegulationAgent(BaseAgent):
+class MarketAnalysis(PromptTemplateAgent):
+    """Ein Agent, der die Markt-Dynamiken recherchiert"""
+
+    name: ClassVar[str] = "Market Analyst"
+    persona: ClassVar[str] = MARKET_PERSONA
+    description: ClassVar[str] = f"Dieser Agent heisst: {name.lower()}. Er kann informationen zu Market Trends recherchieren"
+    user_template: ClassVar[str] = "Recherchiere das folgende Thema aus deiner Perspektive:\n\n{task}"
+    activity: ClassVar[str] = "übersetzt und fasst den Text zusammen"
+
+
+class RegulationAgent(PromptTemplateAgent):
     """Ein Agent, der Regulationen in der Schweiz recherchiert"""
 
-    def __init__(self, client=None):
-        name = "Regulation Expert"
-        persona = "Du bist ein erfahrener Regulationen-Spezialist. Du sammelst nur Informationen zu Regulationen zu einem Thema in der Schweiz."
-        
-        # Use global client if none provided
-        if client is None:
-            try:
-                import __main__
-                client = __main__.client
-            except AttributeError:
-                raise ValueError("No client provided and no global 'client' found. Please pass a client parameter.")
-        
-        super().__init__(name, persona, client)
-        self.description = f"Dieser Agent heisst: {self.name.lower()}. Er kann Informationen zu aktuellen Schweizer Regulationen sammeln."
+    name: ClassVar[str] = "Regulation Expert"
+    persona: ClassVar[str] = REGULATION_PERSONA
+    description: ClassVar[str] = f"Dieser Agent heisst: {name.lower()}. Er kann Informationen zu aktuellen Schweizer Regulationen sammeln."
+    user_template: ClassVar[str] = "Recherchiere zum folgenden Thema aus deiner Perspektive:\n\n{task}"
+    activity: ClassVar[str] = "überprüft die Fakten"
+
+
+class MultiPersonaAgent(BaseAgent):
+    """Ein Agent, der die drei Recherche-Perspektiven (Technologie, Markt, Regulation) in einem einzigen API-Aufruf abdeckt."""
+
+    name: ClassVar[str] = "Multi-Persona Expert"
+    persona: ClassVar[str] = MULTI_PERSONA
+    description: ClassVar[str] = f"Dieser Agent heisst: {name.lower()}. Er liefert Technologie-, Markt- und Regulations-Recherche mit nur einer Anfrage."
+
+    def __init__(self):
+        # Wie PromptTemplateAgent: Aufrufe laufen über die gemeinsamen Clients aus setupenv
+        super().__init__()
 
     def get_description(self):
         """Returns the agent's description."""
         return self.description
 
-    def execute(self, text: str) -> str:
-        print(f"INFO: {self.name} überprüft die Fakten...")
-        from helpers import call_openai, model
-        system_prompt = self.persona
-        user_prompt = f"Recherchiere zum folgenden Thema aus deiner Perspektive:\n\n{text}"
+    def _user_prompt(self, task: str) -> str:
+        return (
+            f"Recherchiere das folgende Thema aus drei Perspektiven: {task}\n\n"
+            "1. tech: Als Technologie-Analyst recherchierst du nur Informationen zu technologischen Trends.\n"
+            "2. market: Als Markt-Analyst recherchierst du nur Informationen zu Marktdynamiken und wie sich ein Markt entwickelt.\n"
+            "3. policy: Als Regulationen-Spezialist sammelst du nur Informationen zu Regulationen zu diesem Thema in der Schweiz.\n\n"
+            'Antworte als JSON-Objekt im Format {"tech": "...", "market": "...", "policy": "..."}.'
+        )
+
+    def _parse(self, response: str) -> dict:
+        """Zerlegt die JSON-Antwort in das 'inputs'-Dict, das SummaryAgent.run erwartet."""
+        response = (response or "").strip()
+        if response.startswith("```"):
+            # Codeblock mit oder ohne Sprachangabe
+            response = response.removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+        try:
+            sections = json.loads(response)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{self.name} hat kein gültiges JSON geliefert: {e}") from e
+        if not isinstance(sections, dict):
+            raise ValueError(f"{self.name} hat kein JSON-Objekt geliefert, sondern {type(sections).__name__}")
+        missing = {"tech", "market", "policy"} - sections.keys()
+        if missing:
+            raise ValueError(f"{self.name}: fehlende Abschnitte in der Antwort: {', '.join(sorted(missing))}")
+        return {key: sections[key] for key in ("tech", "market", "policy")}
+
+    def execute(self, task: str) -> dict:
+        print(f"INFO: {self.name} recherchiert '{task}' aus drei Perspektiven...")
         response = call_openai(
             model=model,
-            system_prompt=system_prompt,
-            user_prompt=user_prompt
+            system_prompt=self.persona,
+            user_prompt=self._user_prompt(task),
+            prompt_cache_key=self.name,
+            response_format=JSON_OBJECT
         )
-        return response
+        return self._parse(response)
 
+    async def aexecute(self, task: str) -> dict:
+        print(f"INFO: {self.name} recherchiert '{task}' aus drei Perspektiven (async)...")
+        response = await acall_openai(
+            model=model,
+            system_prompt=self.persona,
+            user_prompt=self._user_prompt(task),
+            prompt_cache_key=self.name,
+            response_format=JSON_OBJECT
+        )
+        return self._parse(response)
 
-class SummaryAgent:
-    def __init__(self, client=None):
-        # Use global client if none provided
-        if client is None:
-            try:
-                import __main__
-                client = __main__.client
-            except AttributeError:
-                raise ValueError("No client provided and no global 'client' found. Please pass a client parameter.")
-        
-        self.client = client
 
-    def run(self, text, inputs):
-        combined_prompt = (
+class SummaryAgent:
+    def _combined_prompt(self, text, inputs):
+        return (
+            "Please summarize the combined insights of the expert responses below into a single clear and concise response.\n\n"
             f"The user asked: '{text}'\n\n"
             f"Here are the expert responses:\n"
             f"- Policy Expert: {inputs['policy']}\n\n"
             f"- Technology Expert: {inputs['tech']}\n\n"
-            f"- Market Expert: {inputs['market']}\n\n"
-            "Please summarize the combined insights into a single clear and concise response."
+            f"- Market Expert: {inputs['market']}"
         )
+
+    def compress(self, text):
+        """
+        Verdichtet eine Expertenantwort auf ca. 150 Tokens, bevor sie in den kombinierten Prompt geht.
+        Nur exakte Cache-Treffer: zwei ähnliche Expertentexte würden sonst die Fakten des jeweils anderen liefern.
+        """
+        if len(text) < COMPRESSION_MIN_CHARS:
+            return text
+        return call_openai(
+            model=model,
+            system_prompt=COMPRESSION_PERSONA,
+            user_prompt=text,
+            prompt_cache_key="Summary Compressor",
+            semantic=False
+        )
+
+    async def acompress(self, text):
+        if len(text) < COMPRESSION_MIN_CHARS:
+            return text
+        return await acall_openai(
+            model=model,
+            system_prompt=COMPRESSION_PERSONA,
+            user_prompt=text,
+            prompt_cache_key="Summary Compressor",
+            semantic=False
+        )
+
+    async def _acollect_compressed(self, source):
+        return await self.acompress(await _collect(source))
+
+    def run(self, text, inputs):
+        # Map: die drei Expertenantworten parallel verdichten, Reduce: nur die Kurzfassungen zusammenführen
+        with ThreadPoolExecutor(max_workers=len(inputs)) as pool:
+            inputs = dict(zip(inputs, pool.map(self.compress, inputs.values())))
+        combined_prompt = self._combined_prompt(text, inputs)
+        print(f"Summary Agent resolving prompt: {combined_prompt}")
+
+        return call_openai(
+            model=model,
+            system_prompt=SUMMARY_PERSONA,
+            user_prompt=combined_prompt,
+            temperature=0.7,
+            prompt_cache_key="Summary Agent"
+        )
+
+    async def arun(self, text, inputs):
+        """Async-Variante von run; 'inputs' darf wie bei astream auch Coroutinen oder Async-Generatoren enthalten."""
+        keys = list(inputs)
+        texts = await asyncio.gather(*(self._acollect_compressed(inputs[key]) for key in keys))
+        combined_prompt = self._combined_prompt(text, dict(zip(keys, texts)))
+        print(f"Summary Agent resolving prompt: {combined_prompt}")
+
+        return await acall_openai(
+            model=model,
+            system_prompt=SUMMARY_PERSONA,
+            user_prompt=combined_prompt,
+            temperature=0.7,
+            prompt_cache_key="Summary Agent"
+        )
+
+    async def astream(self, text, inputs):
+        """
+        Streamt die Zusammenfassung Stück für Stück.
+        Die Werte in 'inputs' dürfen Strings, Coroutinen (z.B. agent.aexecute(...)) oder
+        Async-Generatoren (z.B. agent.astream(...)) sein; sie werden gleichzeitig eingesammelt.
+        """
+        keys = list(inputs)
+        # Jede Expertenantwort wird verdichtet, sobald sie fertig ist, ohne auf die anderen zu warten
+        texts = await asyncio.gather(*(self._acollect_compressed(inputs[key]) for key in keys))
+        combined_prompt = self._combined_prompt(text, dict(zip(keys, texts)))
         print(f"Summary Agent resolving prompt: {combined_prompt}")
 
-        response = self.client.chat.completions.create(
+        async for delta in acall_openai_stream(
             model=model,
-            messages=[
-                {"role": "system", "content": "You are an energy strategist skilled at synthesizing expert insights."},
-                {"role": "user", "content": combined_prompt}
-            ],
-            temperature=0.7
+            system_prompt=SUMMARY_PERSONA,
+            user_prompt=combined_prompt,
+            temperature=0.7,
+            prompt_cache_key="Summary Agent"
+        ):
+            yield delta
+
+
+class BatchPipeline:
+    """
+    Verarbeitet viele Themen gesammelt über die Azure OpenAI Batch-API.
+    Ca. 50% günstiger und mit eigenem Rate-Limit, dafür kommen die Ergebnisse erst innerhalb von 24h.
+    """
+
+    def __init__(self, client=None, deployment=None):
+        self.client = client or _default_client
+        # Für Azure muss das ein Deployment vom Typ "Global Batch" sein
+        self.model = deployment or model
+        self.agents = AGENTS
+        self.summary_agent = SummaryAgent()
+        self.tasks = {}
+
+    def submit(self, tasks: list[str]) -> str:
+        """Schreibt pro (Thema, Agent) eine JSONL-Zeile, lädt die Datei hoch und startet den Batch. Gibt die batch_id zurück."""
+        jsonl = io.BytesIO()
+        requests = 0
+        for i, task in enumerate(tasks):
+            for key, agent in self.agents.items():
+                jsonl.write(orjson.dumps({
+                    "custom_id": f"{i}:{key}",
+                    "method": "POST",
+                    "url": "/chat/completions",
+                    "body": {
+                        "model": self.model,
+                        "messages": [
+                            {"role": "system", "content": agent.persona},
+                            {"role": "user", "content": agent._user_prompt(task)}
+                        ],
+                        "temperature": 0,
+                        **prompt_cache_hint(agent.name)
+                    }
+                }) + b"\n")
+                requests += 1
+
+        batch_file = self.client.files.create(
+            file=("research_batch.jsonl", jsonl.getvalue()),
+            purpose="batch"
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/chat/completions",
+            completion_window="24h"
         )
-        return response.choices[0].message.content
\ No newline at end of file
+        self.tasks[batch.id] = list(tasks)
+        print(f"✓ Batch {batch.id} mit {requests} Anfragen für {len(tasks)} Themen gestartet")
+        return batch.id
+
+    def collect(self, batch_id: str, tasks: list[str] = None, poll_interval: int = 30) -> list[dict]:
+        """
+        Wartet, bis der Batch fertig ist, ordnet die Antworten über die custom_id wieder den Themen zu
+        und lässt für jedes Thema den SummaryAgent laufen.
+        'tasks' wird nur gebraucht, wenn der Batch von einer anderen BatchPipeline-Instanz gestartet wurde.
+        """
+        if tasks is None:
+            tasks = self.tasks[batch_id]
+
+        batch = self.client.batches.retrieve(batch_id)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            print(f"INFO: Batch {batch_id} ist {batch.status}, warte {poll_interval}s...")
+            time.sleep(poll_interval)
+            batch = self.client.batches.retrieve(batch_id)
+
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(f"Batch {batch_id} endete mit Status '{batch.status}'")
+
+        results = [{} for _ in tasks]
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = orjson.loads(line)
+            index, key = record["custom_id"].split(":")
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                results[int(index)][key] = f"An error occurred: {record.get('error') or response.get('body')}"
+            else:
+                results[int(index)][key] = response["body"]["choices"][0]["message"]["content"]
+
+        summaries = []
+        for task, inputs in zip(tasks, results):
+            for key in self.agents:
+                inputs.setdefault(key, "An error occurred: keine Antwort im Batch-Ergebnis")
+            summaries.append({"task": task, "inputs": inputs, "summary": self.summary_agent.run(task, inputs)})
+        return summaries
+
+
+async def _collect(source):
+    """Wartet auf ein Agenten-Ergebnis, egal ob String, Coroutine oder Async-Generator."""
+    if hasattr(source, "__aiter__"):
+        return "".join([delta async for delta in source])
+    if asyncio.iscoroutine(source) or asyncio.isfuture(source):
+        return await source
+    return source
+
+
+# Die Agenten sind zustandslos bezüglich der Aufgabe: eine Instanz pro Agent reicht für alle Themen
+AGENTS = {
+    "tech": TechnologyAgent(),
+    "market": MarketAnalysis(),
+    "policy": RegulationAgent(),
+}
+
+
+async def run_research(task: str, agents: dict = None, min_results: int = None, tail_factor: float = 0.5) -> dict:
+    """
+    Startet die Recherche-Agenten gleichzeitig und liefert die Ergebnisse für den SummaryAgent.
+
+    Sobald 'min_results' Agenten fertig sind (Standard: alle ausser einem), bekommen die übrigen
+    noch 'tail_factor' x die mittlere Laufzeit der fertigen Agenten. Wer dann nicht fertig ist,
+    wird abgebrochen und im Ergebnis als SKIPPED markiert, damit ein langsamer Ausreisser
+    nicht die ganze Pipeline aufhält. Mit min_results=len(agents) wird auf alle gewartet.
+    """
+    agents = agents or AGENTS
+    if min_results is None:
+        min_results = len(agents) - 1
+
+    started = time.perf_counter()
+    tasks = {asyncio.create_task(agent.aexecute(task)): key for key, agent in agents.items()}
+    pending = set(tasks)
+    results = {}
+    latencies = []
+
+    def _take(done):
+        for finished in done:
+            results[tasks[finished]] = finished.result()
+            latencies.append(time.perf_counter() - started)
+
+    try:
+        while pending and len(results) < min_results:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            _take(done)
+
+        if pending:
+            deadline = tail_factor * sum(latencies) / len(latencies) if latencies else None
+            done, pending = await asyncio.wait(pending, timeout=deadline)
+            _take(done)
+            for slow in pending:
+                print(f"INFO: {agents[tasks[slow]].name} nach {deadline:.1f}s Frist übersprungen")
+                results[tasks[slow]] = SKIPPED
+    finally:
+        for slow in pending:
+            slow.cancel()
+
+    return {key: results[key] for key in agents}
+
+
+async def run_pipeline(task: str, agents: dict = None) -> str:
+    """Recherche (parallel) und anschliessende Zusammenfassung, komplett async."""
+    inputs = await run_research(task, agents)
+    return await SummaryAgent().arun(task, inputs)
+
+
+async def stream_pipeline(task: str, agents: dict = None) -> str:
+    """Recherche (mit Frist für langsame Agenten), danach die Zusammenfassung als Stream direkt auf stdout."""
+    inputs = await run_research(task, agents)
+    chunks = []
+    async for delta in SummaryAgent().astream(task, inputs):
+        print(delta, end="", flush=True)
+        chunks.append(delta)
+    print()
+    return "".join(chunks)
+
+
+if __name__ == "__main__":
+    task = "What are current trends shaping the future of the energy industry?"
+
+    print("\n=== FINAL SUMMARY ===\n")
+    asyncio.run(stream_pipeline(task))
@@ -0,0 +1,196 @@
+# llm_cache.py
+
+import asyncio
+import functools
+import hashlib
+import inspect
+import threading
+
+import diskcache
+import faiss
+import numpy as np
+import orjson
+
+
+class LLMCache:
+    """
+    Zweistufiger Cache für LLM-Antworten.
+
+    Stufe 1 ist ein exakter SHA-256-Key über alle Aufrufparameter, Stufe 2 eine
+    semantische Suche (Cosinus-Ähnlichkeit) über die Embeddings der User-Prompts.
+    Die semantische Suche läuft nur innerhalb derselben Partition (gleiches Modell,
+    gleicher System-Prompt), damit sich verschiedene Agenten nie Antworten teilen.
+    Gecached wird nur bei temperature == 0.
+
+    namespace trennt die Einträge verschiedener Anwendungen im selben Verzeichnis;
+    mit semantic=False gibt es nur exakte Treffer (für Antworten mit kundenbezogenen Daten).
+    """
+
+    def __init__(self, embed=None, directory="./.llmcache", ttl=7 * 24 * 3600, threshold=0.92,
+                 prompt_field="user_prompt", ignore=(), embedding_model="all-MiniLM-L6-v2",
+                 namespace=None, semantic=True):
+        # Ohne eigene embed-Funktion wird lokal mit einem kleinen Sentence-Transformer eingebettet,
+        # damit ein Cache-Lookup keinen zusätzlichen Netzwerk-Aufruf braucht
+        self.embed = embed or self._embed_local
+        self.embedding_model = embedding_model
+        self._model = None
+        self.store = diskcache.Cache(directory)
+        self.ttl = ttl
+        self.threshold = threshold
+        self.prompt_field = prompt_field
+        self.ignore = set(ignore)
+        self.namespace = namespace
+        self.semantic = semantic
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "bypassed": 0}
+        self._partitions = {}
+        self._lock = threading.Lock()
+        if self.semantic:
+            self._load_index()
+
+    def __call__(self, fn):
+        """Dekoriert eine (sync oder async) Funktion, die einen LLM-Aufruf macht."""
+        signature = inspect.signature(fn)
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                fields = self._fields(signature, args, kwargs)
+                if fields is None:
+                    return await fn(*args, **kwargs)
+                hit, vector = await asyncio.to_thread(self.lookup, fields)
+                if hit is not None:
+                    return hit
+                response = await fn(*args, **kwargs)
+                await asyncio.to_thread(self.store_response, fields, response, vector)
+                return response
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            fields = self._fields(signature, args, kwargs)
+            if fields is None:
+                return fn(*args, **kwargs)
+            hit, vector = self.lookup(fields)
+            if hit is not None:
+                return hit
+            response = fn(*args, **kwargs)
+            self.store_response(fields, response, vector)
+            return response
+        return wrapper
+
+    def _fields(self, signature, args, kwargs):
+        """Bindet die Aufrufparameter; None heisst: Cache umgehen."""
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        fields = {}
+        for name, value in bound.arguments.items():
+            if signature.parameters[name].kind is inspect.Parameter.VAR_KEYWORD:
+                fields.update(value)
+            else:
+                fields[name] = value
+        if fields.get("temperature", 0) != 0:
+            self.stats["bypassed"] += 1
+            return None
+        fields = {k: v for k, v in fields.items() if k not in self.ignore}
+        if self.namespace:
+            fields["namespace"] = self.namespace
+        return fields
+
+    @staticmethod
+    def _digest(payload):
+        return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+    def _partition_key(self, fields):
+        return self._digest({k: v for k, v in fields.items() if k != self.prompt_field})
+
+    def _partition(self, partition_key, dim):
+        if partition_key not in self._partitions:
+            self._partitions[partition_key] = (faiss.IndexFlatIP(dim), [])
+        return self._partitions[partition_key]
+
+    def _embed_local(self, text):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(self.embedding_model)
+        return self._model.encode(text, normalize_embeddings=True)
+
+    def _embedding(self, text):
+        vector = np.asarray([self.embed(text)], dtype="float32")
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _load_index(self):
+        """Baut die FAISS-Indizes aus den noch gültigen Einträgen im Disk-Cache auf."""
+        for key in self.store.iterkeys():
+            entry = self.store.get(key)
+            if entry is None or entry["embedding"] is None:
+                continue
+            vector = np.asarray([entry["embedding"]], dtype="float32")
+            index, keys = self._partition(entry["partition"], vector.shape[1])
+            if index.d != vector.shape[1]:
+                # Eintrag stammt von einem anderen Embedding-Modell, nur noch exakt auffindbar
+                continue
+            index.add(vector)
+            keys.append(key)
+
+    def lookup(self, fields):
+        """
+        Sucht eine gecachte Antwort (erst exakt, dann semantisch).
+        Gibt (Antwort oder None, berechnetes Embedding oder None) zurück, damit
+        das Embedding bei einem Miss nicht ein zweites Mal berechnet werden muss.
+        """
+        entry = self.store.get(self._digest(fields))
+        if entry is not None:
+            self.stats["exact_hits"] += 1
+            return entry["response"], None
+
+        vector = None
+        if not self.semantic:
+            self.stats["misses"] += 1
+            return None, vector
+
+        partition = self._partitions.get(self._partition_key(fields))
+        if partition is not None and partition[0].ntotal:
+            index, keys = partition
+            try:
+                vector = self._embedding(fields[self.prompt_field])
+            except Exception as e:
+                print(f"✗ Semantic cache lookup failed: {e}")
+            else:
+                with self._lock:
+                    scores, ids = index.search(vector, 1)
+                    best_key = keys[ids[0][0]]
+                if scores[0][0] >= self.threshold:
+                    entry = self.store.get(best_key)
+                    if entry is not None:
+                        self.stats["semantic_hits"] += 1
+                        return entry["response"], vector
+
+        self.stats["misses"] += 1
+        return None, vector
+
+    def store_response(self, fields, response, vector=None):
+        """Speichert eine Antwort unter ihrem exakten Key und im semantischen Index."""
+        if vector is None and self.semantic:
+            try:
+                vector = self._embedding(fields[self.prompt_field])
+            except Exception as e:
+                print(f"✗ Could not embed prompt for semantic cache: {e}")
+        key = self._digest(fields)
+        partition_key = self._partition_key(fields)
+        self.store.set(
+            key,
+            {
+                "response": response,
+                "embedding": vector[0].tolist() if vector is not None else None,
+                "partition": partition_key
+            },
+            expire=self.ttl
+        )
+        if vector is not None:
+            with self._lock:
+                index, keys = self._partition(partition_key, vector.shape[1])
+                index.add(vector)
+                keys.append(key)
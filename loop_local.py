@@ -0,0 +1,23 @@
+# loop_local.py
+
+import asyncio
+
+# asyncio-Primitive (Lock, Semaphore) und HTTP-Verbindungspools gehören zu genau einer Event-Loop.
+# Pro Loop angelegt bleiben die Module über mehrere asyncio.run()-Aufrufe hinweg nutzbar.
+_loop = None
+_objects = {}
+
+
+def per_loop(name, factory):
+    """
+    Gibt das Objekt 'name' der laufenden Event-Loop zurück und legt es beim ersten Zugriff mit factory() an.
+    Wechselt die Loop, werden die Objekte der vorherigen Loop verworfen.
+    """
+    global _loop
+    loop = asyncio.get_running_loop()
+    if loop is not _loop:
+        _loop = loop
+        _objects.clear()
+    if name not in _objects:
+        _objects[name] = factory()
+    return _objects[name]
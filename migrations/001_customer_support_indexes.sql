@@ -0,0 +1,26 @@
+-- Indexes and key types the support script (supportscript.py) relies on.
+-- Safe to run more than once.
+
+-- Every customer lookup filters on customer_id. The primary key already provides the
+-- unique index; only create one if the table was set up without it.
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = 'customer_support'::regclass
+          AND i.indisunique
+          AND i.indnatts = 1
+          AND a.attname = 'customer_id'
+    ) THEN
+        CREATE UNIQUE INDEX idx_customer_support_customer_id ON customer_support (customer_id);
+    END IF;
+END
+$$;
+
+-- ticket_id is SERIAL (int4). Widen it to BIGINT so the sequence cannot overflow;
+-- INSERT ... RETURNING ticket_id keeps using the column default.
+-- Rewrites the table on first run, later runs are no-ops.
+ALTER TABLE tickets ALTER COLUMN ticket_id TYPE BIGINT;
+ALTER SEQUENCE IF EXISTS tickets_ticket_id_seq AS BIGINT;
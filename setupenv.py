@@ -1,7 +1,16 @@
+import asyncio
+import functools
 import os
-from openai import AzureOpenAI
+import httpx
+import tiktoken
+from aiolimiter import AsyncLimiter
+from openai import AzureOpenAI, AsyncAzureOpenAI
 from dotenv import load_dotenv
 
+from azure_retry import retry_transient
+from llm_cache import LLMCache
+from loop_local import per_loop
+
 # Load environment variables and initialize OpenAI client
 load_dotenv()
 
@@ -18,25 +27,243 @@ if not api_key or not azure_endpoint:
     raise ValueError("Azure OpenAI configuration missing. Please set AZURE_OPENAI_API_KEY, AZURE_OPENAI_ENDPOINT, and AZURE_OPENAI_DEPLOYMENT_NAME in your .env file.")
 
 # Configure client for Azure OpenAI
+# Retries are handled by tenacity below (max_retries=0 avoids retrying twice)
 client = AzureOpenAI(
     api_key=api_key,
     api_version=api_version,
     azure_endpoint=azure_endpoint,
+    max_retries=0,
 )
 
-# --- Helper Function for API Calls ---
-def call_openai(system_prompt, user_prompt, model=model):
-    """Simple wrapper for OpenAI API calls."""
+# Async client for concurrent agent calls (asyncio)
+# One shared HTTP/2 connection pool, so all concurrent aexecute() calls reuse the same TCP/TLS connections
+# and multiplex their requests instead of opening one connection each.
+# Pooled connections belong to one event loop, so each loop (each asyncio.run()) gets its own client.
+def _async_client():
+    return per_loop("async_client", lambda: AsyncAzureOpenAI(
+        api_key=api_key,
+        api_version=api_version,
+        azure_endpoint=azure_endpoint,
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=64)
+        ),
+    ))
+
+
+# Upper bound for concurrent async requests, so bulk runs stay below the deployment's RPM limit
+max_concurrency = int(os.getenv("AZURE_OPENAI_MAX_CONCURRENCY", 20))
+
+
+def _request_slots():
+    return per_loop("request_slots", lambda: asyncio.Semaphore(max_concurrency))
+
+
+# Client-side token bucket for the deployment's requests-per-minute quota
+requests_per_minute = int(os.getenv("AZURE_OPENAI_RPM", 300))
+
+
+def _rate_limiter():
+    return per_loop("rate_limiter", lambda: AsyncLimiter(requests_per_minute, 60))
+
+
+# --- Retries ---
+# 429s (honouring retry-after), timeouts and connection errors are retried, see azure_retry.py
+_retry_transient = retry_transient(attempts=6)
+
+
+@_retry_transient
+def _create(**kwargs):
+    return client.chat.completions.create(**kwargs)
+
+
+@_retry_transient
+async def _acreate(**kwargs):
+    async with _rate_limiter():
+        return await _async_client().chat.completions.create(**kwargs)
+
+
+# --- Prompt Prefix Caching ---
+# prompt_cache_key helps Azure route identical prompt prefixes to the same cache.
+# It needs a recent api-version (older ones reject unknown arguments), so it is opt-in.
+use_prompt_cache_key = os.getenv("AZURE_OPENAI_PROMPT_CACHE_KEY", "false").lower() == "true"
+
+
+def prompt_cache_hint(prompt_cache_key):
+    """Extra kwargs for chat.completions.create: {'prompt_cache_key': ...} if enabled, else {}."""
+    if use_prompt_cache_key and prompt_cache_key:
+        return {"prompt_cache_key": prompt_cache_key}
+    return {}
+
+
+# --- Message Building ---
+@functools.lru_cache(maxsize=64)
+def _system_message(system_prompt):
+    # Agents reuse the same persona on every call, so the system message dict is built once per persona
+    return {"role": "system", "content": system_prompt}
+
+
+def _messages(system_prompt, user_prompt):
+    return [_system_message(system_prompt), {"role": "user", "content": user_prompt}]
+
+
+# --- Token Budget ---
+# Prompts are counted locally, so an oversized request is shortened before it costs a round-trip
+context_window = int(os.getenv("AZURE_OPENAI_CONTEXT_WINDOW", 128000))
+# The model's own output limit (gpt-4o-mini: 16384); max_tokens is only sent when less room than that is left
+max_output_tokens = int(os.getenv("AZURE_OPENAI_MAX_OUTPUT_TOKENS", 16384))
+# Room for the chat message framing tokens
+_message_overhead = 512
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding():
+    # Loaded on first use: tiktoken downloads the BPE file the first time
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0
-        )
-        return response.choices[0].message.content
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Azure deployment names are not always model names
+            return tiktoken.get_encoding("o200k_base")
     except Exception as e:
-        return f"An error occurred: {e}"
-    
+        # Offline or firewalled: send prompts unchecked instead of failing every call
+        print(f"✗ Could not load tokenizer, prompts are not counted locally: {e}")
+        return None
+
+
+@functools.lru_cache(maxsize=64)
+def _prompt_tokens(system_prompt):
+    return len(_encoding().encode(system_prompt))
+
+
+def _fit_prompt(system_prompt, user_prompt):
+    """
+    Truncates the user prompt if the request would not fit the context window; returns (user_prompt, max_tokens).
+    max_tokens is None unless the remaining window is smaller than the model's output limit.
+    Raises ValueError if the system prompt alone does not fit.
+    """
+    if _encoding() is None:
+        return user_prompt, None
+    system_tokens = _prompt_tokens(system_prompt)
+    budget = context_window - max_output_tokens - system_tokens - _message_overhead
+    if budget <= 0:
+        # Nothing left for the user prompt: fail locally instead of paying for a round-trip Azure would reject
+        raise ValueError(
+            f"System prompt has {system_tokens} tokens, which leaves no room for the user prompt "
+            f"(context window {context_window}, {max_output_tokens} reserved for the answer)."
+        )
+    user_tokens = _encoding().encode(user_prompt)
+    if len(user_tokens) > budget:
+        print(f"✗ Prompt has {system_tokens + len(user_tokens)} tokens, truncating user prompt to {budget} tokens")
+        user_tokens = user_tokens[:budget]
+        user_prompt = _encoding().decode(user_tokens)
+    remaining = context_window - system_tokens - len(user_tokens) - _message_overhead
+    return user_prompt, remaining if remaining < max_output_tokens else None
+
+
+def _request(system_prompt, user_prompt, model, temperature, prompt_cache_key, response_format=None):
+    """Keyword arguments for chat.completions.create."""
+    user_prompt, max_tokens = _fit_prompt(system_prompt, user_prompt)
+    request = dict(
+        model=model,
+        messages=_messages(system_prompt, user_prompt),
+        temperature=temperature,
+        **prompt_cache_hint(prompt_cache_key)
+    )
+    if max_tokens is not None:
+        request["max_tokens"] = max_tokens
+    if response_format is not None:
+        request["response_format"] = response_format
+    return request
+
+
+def _content(response):
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        print("✗ Answer was cut off at the output token limit")
+    return choice.message.content
+
+
+# --- LLM Response Cache ---
+# The semantic tier embeds prompts locally (sentence-transformers), so a lookup costs no extra API call.
+# Semantic (near-duplicate) hits are opt-in per call: the research prompts are a fixed template plus a short topic,
+# so two similar topics would otherwise get each other's answers.
+_cache_settings = dict(
+    embedding_model=os.getenv("LLM_CACHE_EMBEDDING_MODEL", "all-MiniLM-L6-v2"),
+    directory=os.getenv("LLM_CACHE_DIR", "./.llmcache"),
+    ttl=int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600)),
+    ignore=("prompt_cache_key",),
+)
+exact_cache = LLMCache(semantic=False, **_cache_settings)
+
+
+def _chat(system_prompt, user_prompt, model=model, temperature=0, prompt_cache_key=None, response_format=None):
+    response = _create(**_request(system_prompt, user_prompt, model, temperature, prompt_cache_key, response_format))
+    return _content(response)
+
+
+async def _achat(system_prompt, user_prompt, model=model, temperature=0, prompt_cache_key=None, response_format=None):
+    async with _request_slots():
+        response = await _acreate(**_request(system_prompt, user_prompt, model, temperature, prompt_cache_key, response_format))
+    return _content(response)
+
+
+_exact_chat = exact_cache(_chat)
+_exact_achat = exact_cache(_achat)
+
+
+@functools.lru_cache(maxsize=None)
+def semantic_cache():
+    """The semantic cache, built on the first semantic=True call (loading it reads every cache entry into FAISS)."""
+    return LLMCache(**_cache_settings)
+
+
+@functools.lru_cache(maxsize=None)
+def _semantic_chats():
+    return semantic_cache()(_chat), semantic_cache()(_achat)
+
+
+# --- Helper Function for API Calls ---
+def call_openai(system_prompt, user_prompt, model=model, temperature=0, prompt_cache_key=None, semantic=False,
+                response_format=None):
+    """
+    Simple wrapper for OpenAI API calls (cached when temperature == 0).
+    Transient errors (429, timeouts, connection errors) are retried; anything else is raised.
+    semantic=True also reuses answers of near-duplicate prompts; only use it where the answer does not depend on the exact input.
+    response_format is passed on to Azure, e.g. {"type": "json_object"}.
+    """
+    chat = _semantic_chats()[0] if semantic else _exact_chat
+    return chat(system_prompt, user_prompt, model=model, temperature=temperature, prompt_cache_key=prompt_cache_key,
+                response_format=response_format)
+
+
+async def acall_openai(system_prompt, user_prompt, model=model, temperature=0, prompt_cache_key=None, semantic=False,
+                       response_format=None):
+    """Async wrapper for OpenAI API calls, so several agents can wait on Azure at the same time."""
+    chat = _semantic_chats()[1] if semantic else _exact_achat
+    return await chat(system_prompt, user_prompt, model=model, temperature=temperature, prompt_cache_key=prompt_cache_key,
+                      response_format=response_format)
+
+
+def call_openai_stream(system_prompt, user_prompt, model=model, temperature=0, prompt_cache_key=None):
+    """Streaming variant of call_openai: yields the answer chunk by chunk as Azure generates it."""
+    stream = _create(
+        stream=True,
+        **_request(system_prompt, user_prompt, model, temperature, prompt_cache_key)
+    )
+    for chunk in stream:
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+
+
+async def acall_openai_stream(system_prompt, user_prompt, model=model, temperature=0, prompt_cache_key=None):
+    """Async streaming variant of call_openai for use with 'async for'."""
+    async with _request_slots():
+        stream = await _acreate(
+            stream=True,
+            **_request(system_prompt, user_prompt, model, temperature, prompt_cache_key)
+        )
+        async for chunk in stream:
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ""